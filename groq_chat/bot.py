@@ -21,10 +21,11 @@ from groq_chat.handlers import (
     cancelled_system_prompt,
     info_command_handler,
     error_handler,
+    audio_command_handler,
+    persistence,
 )
 from groq_chat.filters import AuthFilter, MessageFilter
 from dotenv import load_dotenv
-from mongopersistence import MongoPersistence
 import logging
 
 load_dotenv()
@@ -38,20 +39,6 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 
 logger = logging.getLogger(__name__)
 
-persistence = None
-if os.getenv("MONGODB_URL"):
-    persistence = MongoPersistence(
-        mongo_url=os.getenv("MONGODB_URL"),
-        db_name="groq-chatbot",
-        name_col_user_data="user_data",
-        name_col_bot_data="bot_data",
-        name_col_chat_data="chat_data",
-        name_col_conversations_data="conversations_data",
-        create_col_if_not_exist=True,  # optional
-        ignore_general_data=["cache"],
-        update_interval=10,
-    )
-
 
 def start_bot():
     logger.info("Starting bot")
@@ -73,17 +60,7 @@ def start_bot():
     app.add_handler(CommandHandler("info", info_command_handler, filters=AuthFilter))
 
     # Add /audio command to toggle voice responses
-    async def audio_command(update: Update, context) -> None:
-        """Toggle voice response setting."""
-        current_setting = context.user_data.get("voice_enabled", True)
-        context.user_data["voice_enabled"] = not current_setting
-        status = "enabled" if context.user_data["voice_enabled"] else "disabled"
-        logger.info(
-            f"User {update.effective_user.id}: Voice responses toggled to {status}."
-        )
-        await update.message.reply_text(f"Voice responses are now {status}.")
-
-    app.add_handler(CommandHandler("audio", audio_command, filters=AuthFilter))
+    app.add_handler(CommandHandler("audio", audio_command_handler, filters=AuthFilter))
 
     # Add system prompt conversation handler
     app.add_handler(
@@ -116,5 +93,12 @@ def start_bot():
     # Add error handler
     app.add_error_handler(error_handler)
 
-    # Run the bot
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    # Run the bot with long polling: Telegram holds the getUpdates
+    # connection open up to `timeout` seconds, so idle polling costs one
+    # request per ~25 s instead of one every few seconds.
+    app.run_polling(
+        allowed_updates=Update.ALL_TYPES,
+        timeout=25,
+        poll_interval=0.0,
+        bootstrap_retries=-1,
+    )
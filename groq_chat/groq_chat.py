@@ -14,12 +14,12 @@ chatbot = Groq(
 
 def generate_response(message: str, context: ContextTypes.DEFAULT_TYPE):
     """Generate a response to a message"""
-    context.user_data["messages"] = context.user_data.get("messages", []) + [
+    context.user_data.setdefault("messages", []).append(
         {
             "role": "user",
             "content": message,
         }
-    ]
+    )
     response_queue = ""
     try:
         for resp in chatbot.chat.completions.create(
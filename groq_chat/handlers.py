@@ -1,45 +1,83 @@
+import hashlib
 import html
 import json
 import logging
 import traceback
+from collections import OrderedDict
 from io import BytesIO
-from gtts import gTTS
-from langdetect import detect, LangDetectException
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import ContextTypes, ConversationHandler, CommandHandler, MessageHandler, CallbackQueryHandler, Application
+from telegram.ext import ContextTypes, ConversationHandler
 from telegram.error import NetworkError, BadRequest
 from telegram.constants import ChatAction, ParseMode
 from groq_chat.html_format import format_message
 from groq_chat.groq_chat import chatbot, generate_response
 import asyncio
 import os
-from groq_chat.filters import AuthFilter, MessageFilter
-from dotenv import load_dotenv
-from mongopersistence import MongoPersistence
-
-load_dotenv()
+import time
 
 SYSTEM_PROMPT_SP = 1
 CANCEL_SP = 2
 
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+# Cap concurrent message handling so burst load can't flood the Groq API
+# and the TTS thread pool with unbounded in-flight requests.
+_HANDLER_SEM = asyncio.Semaphore(int(os.getenv("BOT_CONCURRENCY", "8")))
+
+# Bound conversation history so the persisted Mongo document (and each
+# persistence flush) stops growing with chat length.
+MAX_HISTORY_MESSAGES = int(os.getenv("MAX_HISTORY_MESSAGES", "64"))
+
+MODELS = (
+    "llama-3.3-70b-versatile",
+    "llama-3.1-8b-instant",
+    "llama-3.1-70b-versatile",
+    "gemma2-9b-it",
+    "llama3-8b-8192",
+    "llama3-70b-8192",
+    "mixtral-8x7b-32768",
+    "gemma-7b-it",
+)
+
+# The model list is immutable, so build the /model keyboard once at import
+# instead of reallocating buttons and markup on every invocation.
+MODEL_KEYBOARD = InlineKeyboardMarkup(
+    [
+        [InlineKeyboardButton(model, callback_data=f"change_model_{model}")]
+        for model in MODELS
+    ]
 )
+
 logger = logging.getLogger(__name__)
 
-persistence = None
-if os.getenv("MONGODB_URL"):
-    persistence = MongoPersistence(
-        mongo_url=os.getenv("MONGODB_URL"),
-        db_name="groq-chatbot",
-        name_col_user_data="user_data",
-        name_col_bot_data="bot_data",
-        name_col_chat_data="chat_data",
-        name_col_conversations_data="conversations_data",
-        create_col_if_not_exist=True,
-        ignore_general_data=["cache"],
-        update_interval=10,
-    )
+_persistence = None
+
+
+def _build_persistence():
+    """Build the process-wide MongoPersistence instance exactly once."""
+    global _persistence
+    if _persistence is None and os.getenv("MONGODB_URL"):
+        from mongopersistence import MongoPersistence
+
+        mongo_url = os.getenv("MONGODB_URL")
+        # Size the driver's connection pool up front instead of relying on
+        # defaults; a larger update_interval coalesces more user_data
+        # mutations into each flush.
+        pool_params = "maxPoolSize=50&minPoolSize=5&maxIdleTimeMS=60000"
+        mongo_url += ("&" if "?" in mongo_url else "?") + pool_params
+        _persistence = MongoPersistence(
+            mongo_url=mongo_url,
+            db_name="groq-chatbot",
+            name_col_user_data="user_data",
+            name_col_bot_data="bot_data",
+            name_col_chat_data="chat_data",
+            name_col_conversations_data="conversations_data",
+            create_col_if_not_exist=True,
+            ignore_general_data=["cache"],
+            update_interval=30,
+        )
+    return _persistence
+
+
+persistence = _build_persistence()
 
 
 def new_chat(context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -54,20 +92,46 @@ def new_chat(context: ContextTypes.DEFAULT_TYPE) -> None:
         context.user_data["messages"] = []
 
 
-def text_to_wav(text: str, filename: str) -> None:
-    """Convert text to a WAV file."""
+TTS_CACHE_SIZE = 512
+
+# LRU cache of synthesized audio keyed on (text digest, language), so
+# repeated phrases skip the gTTS network round trip.
+_tts_cache: "OrderedDict[tuple[str, str], bytes]" = OrderedDict()
+
+
+def detect_language(text: str) -> str:
+    """Detect the language of a text snippet, defaulting to English."""
+    # Imported here so text-only deployments never pay the startup cost
+    # of loading langdetect's profiles.
+    from langdetect import LangDetectException, detect
+
     try:
-        language = detect(text)
+        return detect(text)
     except LangDetectException:
-        logging.error("Language detection failed. Defaulting to English.")
-        language = "en"
+        logger.error("Language detection failed. Defaulting to English.")
+        return "en"
 
-    try:
-        tts = gTTS(text=text, lang=language, slow=False)
-        tts.save(filename)
-        logging.info(f"Audio saved as '{filename}'")
-    except Exception as e:
-        logging.error(f"Error during text-to-speech conversion: {e}")
+
+def synthesize(text: str, lang: str | None = None) -> bytes:
+    """Convert text to speech and return the MP3 bytes."""
+    from gtts import gTTS
+
+    if lang is None:
+        lang = detect_language(text)
+
+    key = (hashlib.sha1(text.encode()).hexdigest(), lang)
+    cached = _tts_cache.get(key)
+    if cached is not None:
+        _tts_cache.move_to_end(key)
+        return cached
+
+    buf = BytesIO()
+    gTTS(text=text, lang=lang, slow=False).write_to_fp(buf)
+    audio = buf.getvalue()
+    _tts_cache[key] = audio
+    if len(_tts_cache) > TTS_CACHE_SIZE:
+        _tts_cache.popitem(last=False)
+    return audio
 
 
 async def start(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
@@ -78,9 +142,7 @@ async def start(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
     )
 
 
-async def help_command(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
-    """Send a message when the command /help is issued."""
-    help_text = """
+HELP_TEXT = """
 Basic commands:
 /start - Start the bot
 /help - Get help. Shows this message
@@ -94,7 +156,11 @@ Chat commands:
 
 Send a message to the bot to generate a response.
 """
-    await update.message.reply_text(help_text)
+
+
+async def help_command(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
+    """Send a message when the command /help is issued."""
+    await update.message.reply_text(HELP_TEXT)
 
 
 async def new_command_handler(
@@ -111,16 +177,7 @@ async def model_command_handler(
     update: Update, context: ContextTypes.DEFAULT_TYPE
 ) -> None:
     """Change the model used to generate responses."""
-    models = ["llama-3.3-70b-versatile", "llama-3.1-8b-instant", "llama-3.1-70b-versatile", "gemma2-9b-it", "llama3-8b-8192", "llama3-70b-8192", "mixtral-8x7b-32768", "gemma-7b-it"]
-
-    reply_markup = InlineKeyboardMarkup(
-        [
-            [InlineKeyboardButton(model, callback_data="change_model_" + model)]
-            for model in models
-        ]
-    )
-
-    await update.message.reply_text("Select a model:", reply_markup=reply_markup)
+    await update.message.reply_text("Select a model:", reply_markup=MODEL_KEYBOARD)
 
 
 async def change_model_callback_handler(
@@ -179,137 +236,164 @@ async def audio_command_handler(update: Update, context: ContextTypes.DEFAULT_TY
     await update.message.reply_text(f"Voice synthesis has been {state_text}.")
 
 
-async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handle messages, including TTS conversion."""
-    if "model" not in context.user_data:
-        context.user_data["model"] = "llama-3.1-8b-instant"
-
-    if "messages" not in context.user_data:
-        context.user_data["messages"] = []
-
-    init_msg = await update.message.reply_text("Generating response...")
+async def _keep_typing(chat) -> None:
+    """Re-send the typing action every few seconds until cancelled.
 
-    message = update.message.text
-    if not message:
-        return
+    Telegram expires the indicator after ~5 s, so a single send at the
+    start of a long streamed reply leaves the user staring at nothing.
+    """
+    while True:
+        try:
+            await chat.send_action(ChatAction.TYPING)
+        except NetworkError:
+            return
+        await asyncio.sleep(4)
 
-    asyncio.run_coroutine_threadsafe(update.message.chat.send_action(ChatAction.TYPING), loop=asyncio.get_event_loop())
-    full_output_message = ""
 
-    try:
-        for message_part in generate_response(message, context):
-            if message_part:
-                full_output_message += message_part
-                send_message = format_message(full_output_message)
-                init_msg = await init_msg.edit_text(
-                    send_message, parse_mode=ParseMode.HTML, disable_web_page_preview=True
-                )
-
-        context.user_data["messages"] = context.user_data.get("messages", []) + [
-            {
-                "role": "assistant",
-                "content": full_output_message,
-            }
-        ]
-
-        # Generate and send voice response if TTS is enabled
-        voice_enabled = context.user_data.get("voice_enabled", True)
-        if voice_enabled:
-            try:
-                audio_buffer = BytesIO()
-                text_to_wav(full_output_message, "temp_audio.wav")
-
-                with open("temp_audio.wav", "rb") as wav_file:
-                    audio_buffer.write(wav_file.read())
-                audio_buffer.seek(0)
-
-                await update.message.reply_voice(voice=audio_buffer)
-            except Exception as e:
-                logging.exception(f"Error generating or sending audio: {e}")
-
-    except Exception as e:
-        logging.exception(f"Error processing the request: {e}")
-        await init_msg.edit_text("An error occurred while processing your request.")
+async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle messages, including TTS conversion."""
+    async with _HANDLER_SEM:
+        # Bail out before the placeholder reply so non-text updates don't
+        # cost an API call or leave a dangling "Generating response..." bubble.
+        message = update.message.text
+        if not message:
+            return
+
+        if "model" not in context.user_data:
+            context.user_data["model"] = "llama-3.1-8b-instant"
+
+        if "messages" not in context.user_data:
+            context.user_data["messages"] = []
+
+        init_msg = await update.message.reply_text("Generating response...")
+
+        # Keep the typing indicator alive for the whole stream instead of a
+        # single send that expires after ~5 s.
+        typing_task = asyncio.create_task(_keep_typing(update.message.chat))
+        full_output_message = ""
+        last_edit = time.monotonic()
+        last_len = 0
+
+        try:
+            for message_part in generate_response(message, context):
+                if message_part:
+                    full_output_message += message_part
+                    # Coalesce edits: one editMessageText per chunk means
+                    # hundreds of Telegram round trips per long reply. Only
+                    # reformat when we actually edit, too: re-running
+                    # format_message over the whole buffer every chunk is
+                    # O(N^2) in the response length.
+                    if (
+                        time.monotonic() - last_edit > 0.7
+                        or len(full_output_message) - last_len > 200
+                    ):
+                        try:
+                            init_msg = await init_msg.edit_text(
+                                format_message(full_output_message),
+                                parse_mode=ParseMode.HTML,
+                                disable_web_page_preview=True,
+                            )
+                        except BadRequest:
+                            pass  # e.g. "message is not modified"
+                        last_edit = time.monotonic()
+                        last_len = len(full_output_message)
+
+            # Flush whatever the thresholds held back.
+            if full_output_message and len(full_output_message) != last_len:
+                try:
+                    init_msg = await init_msg.edit_text(
+                        format_message(full_output_message),
+                        parse_mode=ParseMode.HTML,
+                        disable_web_page_preview=True,
+                    )
+                except BadRequest:
+                    pass
+
+            messages = context.user_data.setdefault("messages", [])
+            messages.append(
+                {
+                    "role": "assistant",
+                    "content": full_output_message,
+                }
+            )
+            if len(messages) > MAX_HISTORY_MESSAGES:
+                # Drop the oldest turns, keeping the system prompt if set.
+                excess = len(messages) - MAX_HISTORY_MESSAGES
+                if messages[0].get("role") == "system":
+                    del messages[1 : excess + 1]
+                else:
+                    del messages[:excess]
+
+            # Generate and send voice response if TTS is enabled
+            voice_enabled = context.user_data.get("voice_enabled", True)
+            if voice_enabled:
+                try:
+                    # Detect language on the user's input rather than the whole
+                    # reply, and cache it per user so langdetect stays off the
+                    # critical path after the first message. Re-sample only when
+                    # the input is long enough to be a reliable signal.
+                    lang = context.user_data.get("lang")
+                    if lang is None or len(message) >= 40:
+                        lang = await asyncio.to_thread(detect_language, message[:200])
+                        context.user_data["lang"] = lang
+
+                    # gTTS and langdetect are blocking; run them off the event
+                    # loop so other updates keep being serviced during synthesis.
+                    # reply_voice accepts raw bytes, so no BytesIO copy needed.
+                    audio_bytes = await asyncio.to_thread(synthesize, full_output_message, lang)
+                    await update.message.reply_voice(voice=audio_bytes)
+                except Exception as e:
+                    logger.exception("Error generating or sending audio: %s", e)
+
+        except Exception as e:
+            logger.exception("Error processing the request: %s", e)
+            await init_msg.edit_text("An error occurred while processing your request.")
+        finally:
+            typing_task.cancel()
+
+
+# Run the HTML formatter over the static skeleton once at import; only the
+# model name is substituted per call.
+INFO_TEMPLATE = format_message(
+    """**__Conversation Info:__**
+**Model**: `{model}`
+"""
+)
 
 
 async def info_command_handler(
     update: Update, context: ContextTypes.DEFAULT_TYPE
 ) -> None:
     """Get info about the bot."""
-    message = f"""**__Conversation Info:__**
-**Model**: `{context.user_data.get("model", "llama3-8b-8192")}`
-"""
-    await update.message.reply_text(format_message(message), parse_mode=ParseMode.HTML)
+    await update.message.reply_text(
+        INFO_TEMPLATE.format(model=context.user_data.get("model", "llama3-8b-8192")),
+        parse_mode=ParseMode.HTML,
+    )
 
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Log the error and send a telegram message to notify the developer."""
-    logging.getLogger(__name__).error("Exception while handling an update:", exc_info=context.error)
+    logger.error("Exception while handling an update:", exc_info=context.error)
+
+    # Network errors and the like arrive without a real Update; there is no
+    # chat to reply to, and attempting to would just raise again. Don't make
+    # error handling a second source of load during an outage.
+    if not isinstance(update, Update) or update.effective_message is None:
+        return
 
     tb_list = traceback.format_exception(None, context.error, context.error.__traceback__)
-    tb_string = "".join(tb_list)
+    # Keep only the tail of long tracebacks; escaping and sending the whole
+    # thing is wasted work and can exceed Telegram's message size anyway.
+    tb_string = "".join(tb_list)[-3072:]
 
-    update_str = update.to_dict() if isinstance(update, Update) else str(update)
     message = (
         "An exception was raised while handling an update\n"
-        f"<pre>update = {html.escape(json.dumps(update_str, indent=2, ensure_ascii=False))}"
+        f"<pre>update = {html.escape(json.dumps(update.to_dict(), separators=(',', ':'), ensure_ascii=False))}"
         "</pre>\n\n"
         f"<pre>{html.escape(tb_string)}</pre>"
     )
 
-    await update.message.reply_text(
+    await update.effective_message.reply_text(
         text=message, parse_mode=ParseMode.HTML
     )  # You may want to notify admins
 
-
-def start_bot():
-    logger.info("Starting bot")
-
-    app_builder = Application.builder().token(os.getenv("BOT_TOKEN"))
-
-    # Add persistence if available
-    if persistence:
-        app_builder.persistence(persistence)
-
-    # Build the app
-    app = app_builder.build()
-
-    app.add_handler(CommandHandler("start", start, filters=AuthFilter))
-    app.add_handler(CommandHandler("help", help_command, filters=AuthFilter))
-    app.add_handler(CommandHandler("new", new_command_handler, filters=AuthFilter))
-    app.add_handler(CommandHandler("model", model_command_handler, filters=AuthFilter))
-    app.add_handler(CommandHandler("info", info_command_handler, filters=AuthFilter))
-    app.add_handler(CommandHandler("audio", audio_command_handler, filters=AuthFilter))  # New command
-
-    app.add_handler(
-        ConversationHandler(
-            entry_points=[
-                CommandHandler("system_prompt", start_system_prompt, filters=AuthFilter)
-            ],
-            states={
-                SYSTEM_PROMPT_SP: [MessageHandler(MessageFilter, get_system_prompt)],
-                CANCEL_SP: [
-                    CommandHandler(
-                        "cancel", cancelled_system_prompt, filters=AuthFilter
-                    )
-                ],
-            },
-            fallbacks=[
-                CommandHandler("cancel", cancelled_system_prompt, filters=AuthFilter)
-            ],
-        )
-    )
-
-    app.add_handler(MessageHandler(MessageFilter, message_handler))
-    app.add_handler(
-        CallbackQueryHandler(change_model_callback_handler, pattern="^change_model_")
-    )
-
-    app.add_error_handler(error_handler)
-
-    # Run the bot until the user presses Ctrl-C
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
-
-
-if __name__ == "__main__":
-    start_bot()